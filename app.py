@@ -2,24 +2,43 @@
 import os
 import io
 import re
+import csv
+import heapq
+import hashlib
+import hmac
+import gzip
 import json
+import math
+import time
+import functools
+import threading
 import datetime as dt
-from typing import List, Dict, Any, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Dict, Any, Optional, Tuple, Union
+from zoneinfo import ZoneInfo
 
-import pandas as pd
-from flask import Flask, jsonify, request, Response
+import orjson
+from flask import Flask, request, Response
+from flask_compress import Compress
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
-import pytz  # ← 追加（requirements.txt に pytz==2025.2 を追記）
+from werkzeug.http import http_date, quote_etag, unquote_etag
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 # =========================
 # 環境変数
 # =========================
 API_KEY = os.environ.get("API_KEY")  # 任意の長いランダム文字列
+API_KEY_B = API_KEY.encode() if API_KEY else None  # 比較用にバイト列で1回だけ作っておく
 FOLDER_ID = os.environ.get("GDRIVE_FOLDER_ID")  # Google DriveのフォルダID
 SA_PATH = os.environ.get("SERVICE_ACCOUNT_FILE", "/etc/secrets/gcp-service-account.json")
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
+DRIVE_CHUNK_MB = int(os.environ.get("DRIVE_CHUNK_MB", "16"))  # 分割ダウンロード時のチャンク(MiB)
+SINGLE_SHOT_MAX_BYTES = 32 * 1024 * 1024  # これ以下なら一括ダウンロード
+DRIVE_LIST_TTL = int(os.environ.get("DRIVE_LIST_TTL", "30"))  # 一覧APIの結果を使い回す秒数
 
 # =========================
 # Google認証（Secret File or 環境変数JSONのフォールバック）
@@ -36,15 +55,38 @@ else:
             f"Service account not found at {SA_PATH} and SERVICE_ACCOUNT_JSON not set"
         )
 
-drive = build("drive", "v3", credentials=creds)
+# discovery ドキュメントはライブラリ同梱のものを使い、起動時の HTTP 取得とキャッシュ探索を避ける
+drive = build("drive", "v3", credentials=creds, static_discovery=True, cache_discovery=False)
+# drive.files() は呼ぶたびに Resource を組み立て直すので1回だけ作って使い回す。
+# 接続（httplib2 の keep-alive）も drive._http に保持され、Drive ワーカー1本から再利用される
+drive_files = drive.files()
 
 app = Flask(__name__)
 
+# レスポンス圧縮（JSON / YAMLテキスト）
+app.config["COMPRESS_MIMETYPES"] = ["application/json", "text/plain"]
+app.config["COMPRESS_ALGORITHM"] = ["gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 256
+app.config["COMPRESS_LEVEL"] = 1  # 数KB程度の本文なので速度優先
+Compress(app)
+
 # =========================
 # 認可ヘルパ
 # =========================
 def _auth_ok(req) -> bool:
-    return (API_KEY is not None) and (req.headers.get("X-API-Key") == API_KEY)
+    # ヘッダ値は WSGI で latin-1 として渡されるので、latin-1 に戻せば送られてきた生バイト列になる
+    if API_KEY_B is None:
+        return False
+    hdr = req.headers.get("X-API-Key", "")
+    return hmac.compare_digest(hdr.encode("latin-1", "replace"), API_KEY_B)
+
+# =========================
+# JSONレスポンス（orjson でシリアライズ）
+# =========================
+_ORJSON_OPTS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+def _ojson(obj: Any, status: int = 200) -> Response:
+    return Response(orjson.dumps(obj, option=_ORJSON_OPTS), status=status, mimetype="application/json")
 
 # =========================
 # Drive: 最新CSVの取得（メタ付き）
@@ -52,7 +94,7 @@ def _auth_ok(req) -> bool:
 # - mimeType は text/csv, application/vnd.ms-excel を許容
 # - 指定フォルダ「直下」を探索
 # =========================
-_DATE_IN_NAME = re.compile(r"(20\d{2})[-_]?(\d{2})[-_]?(\d{2})")
+_DATE_IN_NAME = re.compile(r"(?:^|[^\d])(20\d{2})[-_]?(\d{2})[-_]?(\d{2})")
 
 def _parse_date_from_name(name: str) -> dt.date:
     m = _DATE_IN_NAME.search(name or "")
@@ -70,7 +112,14 @@ def _parse_iso_dt(s: str) -> dt.datetime:
     except Exception:
         return dt.datetime.min
 
-def download_latest_csv_from_drive_with_meta(folder_id: str) -> Tuple[bytes, Dict[str, Any]]:
+def _parse_iso_dt_fast(s: str) -> Tuple[int, ...]:
+    # Drive の modifiedTime は常に YYYY-MM-DDTHH:MM:SS.sssZ（UTC）なので、
+    # 比較用には datetime を作らず数値タプルで十分
+    if s and len(s) >= 19:
+        return (int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+    return (0,) * 6
+
+def _find_latest_csv(folder_id: str) -> Dict[str, Any]:
     if not folder_id:
         raise ValueError("GDRIVE_FOLDER_ID 未設定")
 
@@ -79,115 +128,408 @@ def download_latest_csv_from_drive_with_meta(folder_id: str) -> Tuple[bytes, Dic
         "mimeType='text/csv' or mimeType='application/vnd.ms-excel'"
         ")"
     )
-    resp = drive.files().list(
-        q=q,
-        fields="files(id,name,modifiedTime,createdTime,size,mimeType)",
-        orderBy="modifiedTime desc",
-        pageSize=100,
-        supportsAllDrives=True,
-        includeItemsFromAllDrives=True,
-    ).execute()
-    files = resp.get("files", [])
+    # 並び替えは手元で行うので orderBy は付けない。100件を超える場合はページを辿る
+    files: List[Dict[str, Any]] = []
+    page_token = None
+    while True:
+        resp = drive_files.list(
+            q=q,
+            fields="nextPageToken,files(id,name,modifiedTime,size)",
+            pageSize=100,
+            pageToken=page_token,
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+        ).execute()
+        files.extend(resp.get("files", []))
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            break
     if not files:
         raise FileNotFoundError("指定フォルダにCSVが見つかりません。")
 
-    def sort_key(f):
-        dname = _parse_date_from_name(f.get("name", ""))
-        mtime = _parse_iso_dt(f.get("modifiedTime", ""))
-        return (dname, mtime)
-
-    files.sort(key=sort_key, reverse=True)
-    latest = files[0]
+    def mtime_key(f):
+        return _parse_iso_dt_fast(f.get("modifiedTime", ""))
 
-    buf = io.BytesIO()
-    req = drive.files().get_media(fileId=latest["id"])
-    downloader = MediaIoBaseDownload(buf, req, chunksize=1024 * 1024)
+    # ファイル名に日付を持つものがあれば、日付なしのファイルは候補から外す
+    dated = []
+    for f in files:
+        dname = _parse_date_from_name(f.get("name", ""))
+        if dname != dt.date.min:
+            dated.append((dname, f))
+    if not dated:
+        return max(files, key=mtime_key)
+
+    # 最新の日付を持つファイル同士だけ modifiedTime で比較
+    top = max(dname for dname, _ in dated)
+    return max((f for dname, f in dated if dname == top), key=mtime_key)
+
+class _PreallocatedWriter:
+    """一覧APIの size で確保した bytearray に先頭から書き込むだけの writer（BytesIO の倍々拡張とコピーを避ける）"""
+
+    def __init__(self, size: int):
+        self.buf = bytearray(size)
+        self.pos = 0
+
+    def write(self, data: bytes) -> int:
+        end = self.pos + len(data)
+        self.buf[self.pos:end] = data  # size より大きくなっていても bytearray 側が伸びる
+        self.pos = end
+        return len(data)
+
+def _download_csv_bytes(file_id: str, size: int = 0) -> Union[bytes, bytearray]:
+    req = drive_files.get_media(fileId=file_id)
+    # 小さいファイルはチャンク分割せず1リクエストで取得
+    if 0 < size <= SINGLE_SHOT_MAX_BYTES:
+        return req.execute()
+
+    out = _PreallocatedWriter(size)
+    downloader = MediaIoBaseDownload(out, req, chunksize=DRIVE_CHUNK_MB * 1024 * 1024)
     done = False
     while not done:
         _, done = downloader.next_chunk()
-    buf.seek(0)
-    meta = {
-        "id": latest["id"],
-        "name": latest.get("name"),
-        "modifiedTime": latest.get("modifiedTime"),  # ISO UTC
-    }
-    return buf.read(), meta
+    if out.pos != len(out.buf):
+        del out.buf[out.pos:]  # 一覧取得後に縮んだ場合
+    return out.buf
+
+# 末尾だけの部分取得（Range 指定）。ヘッダ行も毎回取り直す（同じIDでも列が入れ替わりうる）
+_TAIL_BYTES = 16 * 1024
+
+def _media_range(file_id: str, byte_range: str) -> Tuple[int, bytes]:
+    url = f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media&supportsAllDrives=true"
+    resp, content = drive._http.request(url, method="GET", headers={"Range": f"bytes={byte_range}"})
+    return resp.status, content
+
+def _download_csv_head_and_tail(file_id: str) -> Optional[bytes]:
+    """ヘッダ行 + 末尾 _TAIL_BYTES バイト（先頭の欠けた行は除く）。取れなければ None"""
+    status, content = _media_range(file_id, f"0-{_TAIL_BYTES - 1}")
+    nl = content.find(b"\n")
+    if status not in (200, 206) or nl < 0:
+        return None
+    header = content[:nl + 1]
+
+    status, content = _media_range(file_id, f"-{_TAIL_BYTES}")
+    if status != 206:
+        return None  # 416 などはファイル全体のダウンロードに任せる
+    nl = content.find(b"\n")
+    if nl < 0:
+        return None
+    return header + content[nl + 1:]
 
 # =========================
 # CSV 正規化 → 直近7日
 # =========================
-def _colmap(columns: List[str]) -> Dict[str, str]:
-    lower_map = {c.lower(): c for c in columns}
-
-    def pick(*cands: str) -> str:
-        # 完全一致（lower）優先
-        for key in cands:
-            if key in lower_map:
-                return lower_map[key]
-        # サブストリング柔軟一致
-        for key in cands:
-            for lc, orig in lower_map.items():
-                if key in lc:
-                    return orig
-        return ""
-
-    return {
-        "date": pick("date", "day", "datetime", "start date", "start_date"),
-        "steps": pick("steps", "step", "step_count"),
-        "sleep_hours": pick("sleep_hours", "sleep hour", "sleep_duration", "sleep_duration_hours"),
-        "active_energy_kcal": pick("active_energy_kcal", "move_kcal", "active energy", "active_kcal"),
-        "resting_hr_bpm": pick("resting_hr_bpm", "resting heart", "resting_heart_rate", "rest hr", "restinghr"),
-        "weight_kg": pick("weight_kg", "body mass", "weight"),
-    }
+_COL_CANDIDATES: Dict[str, Tuple[str, ...]] = {
+    "date": ("date", "day", "datetime", "start date", "start_date", "日付", "日時"),
+    "steps": ("steps", "step", "step_count", "歩数"),
+    "sleep_hours": ("sleep_hours", "sleep hour", "sleep_duration", "sleep_duration_hours", "睡眠時間"),
+    "active_energy_kcal": ("active_energy_kcal", "move_kcal", "active energy", "active_kcal",
+                           "アクティブエネルギー", "活動エネルギー"),
+    "resting_hr_bpm": ("resting_hr_bpm", "resting heart", "resting_heart_rate", "rest hr", "restinghr",
+                       "安静時心拍数", "安静時心拍"),
+    "weight_kg": ("weight_kg", "body mass", "weight", "体重"),
+}
+
+# 列名（lower）→ (正規化後の列名, 候補内の優先順位)。完全一致はこの辞書を1回引くだけで済ませる
+_SYNONYMS: Dict[str, Tuple[str, int]] = {
+    c: (k, rank) for k, cands in _COL_CANDIDATES.items() for rank, c in enumerate(cands)
+}
+# 辞書で見つからなかった場合のサブストリング一致用（モジュール読込時に1回だけコンパイル）
+_COL_PATTERNS: Dict[str, "re.Pattern[str]"] = {
+    k: re.compile("|".join(map(re.escape, cands))) for k, cands in _COL_CANDIDATES.items()
+}
 
-def _to_float(x):
+def _colmap(columns: List[str]) -> Dict[str, str]:
+    # 完全一致（lower）優先：列ごとに1回の辞書参照。同じ項目に複数当たれば候補順位の高い方
+    # lower は列ごとに1回だけ（サブストリング一致でも同じリストを使う）
+    lower_cols = [(c.lower(), c) for c in columns]
+    found: Dict[str, Tuple[int, str]] = {}
+    for lc, c in lower_cols:
+        hit = _SYNONYMS.get(lc.strip())
+        if hit is not None:
+            k, rank = hit
+            if k not in found or rank <= found[k][0]:
+                found[k] = (rank, c)
+
+    out: Dict[str, str] = {}
+    lower_map = None
+    for k, pattern in _COL_PATTERNS.items():
+        if k in found:
+            out[k] = found[k][1]
+            continue
+        # サブストリング柔軟一致（辞書に無い列名のときだけ）。候補順位の高いものを含む列を優先し、
+        # 同順位なら左の列。正規表現は当たりそうな列を絞り込むだけに使う
+        if lower_map is None:
+            lower_map = dict(lower_cols)
+        best: Optional[Tuple[int, str]] = None
+        cands = _COL_CANDIDATES[k]
+        for lc, orig in lower_map.items():
+            if pattern.search(lc):
+                rank = next(r for r, cand in enumerate(cands) if cand in lc)
+                if best is None or rank < best[0]:
+                    best = (rank, orig)
+        out[k] = best[1] if best is not None else ""
+    return out
+
+_METRIC_KEYS = ("steps", "sleep_hours", "active_energy_kcal", "resting_hr_bpm", "weight_kg")
+
+# 先頭が YYYY-MM-DD / YYYY/MM/DD の日付（後ろの時刻・タイムゾーンは無視）
+_DAY_PREFIX = re.compile(r"(\d{4})[-/](\d{1,2})[-/](\d{1,2})(?!\d)")
+
+def _parse_day(s: str) -> Optional[dt.date]:
+    # 大半を占める YYYY-MM-DD（後ろに時刻が続くものを含む）は正規表現を通さない
+    if len(s) >= 10 and s[4] == "-" and s[7] == "-" and (len(s) == 10 or not s[10].isdigit()):
+        try:
+            return dt.date.fromisoformat(s[:10])
+        except ValueError:
+            pass
+    m = _DAY_PREFIX.match(s)
+    if not m:
+        return None
+    y, mth, d = map(int, m.groups())
     try:
-        if x is None:
-            return None
-        if isinstance(x, float) and pd.isna(x):
-            return None
-        if isinstance(x, str) and x.strip() == "":
-            return None
-        return float(x)
-    except Exception:
+        return dt.date(y, mth, d)
+    except ValueError:
         return None
 
-def normalize_and_last_7(csv_bytes: bytes) -> List[Dict[str, Any]]:
-    df = pd.read_csv(io.BytesIO(csv_bytes))
-    cmap = _colmap(list(df.columns))
+def _to_float(x: str) -> Optional[float]:
+    s = x.strip()
+    # 数値で始まらないものは例外を起こさずに弾く
+    if not s or s[0] not in "-+.0123456789":
+        return None
+    try:
+        v = float(s)
+    except ValueError:
+        return None
+    # "-nan" / "+inf" などは先頭文字の判定を通ってしまうので、有限値以外は欠損扱い
+    return v if math.isfinite(v) else None
+
+_TAIL_LINES = 32  # 末尾から先に読む行数（日付なし行などの余裕込み）
+
+def normalize_and_last_7(csv_bytes: Union[bytes, bytearray]) -> List[Dict[str, Any]]:
+    # 日付昇順に追記されていくCSVが前提なので、まず「ヘッダ + 末尾数行」だけを解析する。
+    # 末尾が昇順でない・7件に満たない等の場合はファイル全体を読む
+    tail = _csv_head_and_tail(csv_bytes, _TAIL_LINES)
+    if tail is not None:
+        out = _last_7_rows(tail, tail_only=True)
+        if out is not None:
+            return out
+    return _last_7_rows(csv_bytes)
+
+def _csv_head_and_tail(csv_bytes: Union[bytes, bytearray], lines: int) -> Optional[Union[bytes, bytearray]]:
+    nl = csv_bytes.find(b"\n")
+    if nl < 0:
+        return None
+    body = nl + 1
+    end = len(csv_bytes)
+    while end > body and csv_bytes[end - 1] in b"\r\n":
+        end -= 1
+    pos = end
+    for _ in range(lines):
+        pos = csv_bytes.rfind(b"\n", body, pos)
+        if pos < 0:
+            return None  # 行数が少ないファイルは全体を読めば十分
+    return csv_bytes[:body] + csv_bytes[pos + 1:]
+
+def _last_7_rows(csv_bytes: Union[bytes, bytearray], tail_only: bool = False) -> Optional[List[Dict[str, Any]]]:
+    # csv モジュールで1パス走査し、日付上位7件だけをヒープに保持する
+    reader = csv.reader(io.TextIOWrapper(io.BytesIO(csv_bytes), encoding="utf-8-sig", newline=""))
+    header = next(reader, [])
+    cmap = _colmap(header)
 
     # 日付
     if not cmap["date"]:
         raise ValueError("CSVに日付列が見つかりません。")
-    df["_date"] = pd.to_datetime(df[cmap["date"]], errors="coerce").dt.date
 
-    def get_col(key: str):
-        col = cmap[key]
-        return df[col] if col and col in df.columns else None
+    i_date = header.index(cmap["date"])
+    metric_idx = [(k, header.index(cmap[k]) if cmap[k] else -1) for k in _METRIC_KEYS]
 
-    steps = get_col("steps")
-    sleep = get_col("sleep_hours")
-    active = get_col("active_energy_kcal")
-    rhr = get_col("resting_hr_bpm")
-    weight = get_col("weight_kg")
+    heap: List[Tuple[dt.date, int, List[str]]] = []
+    prev_day = None
+    for n, row in enumerate(reader):
+        raw = row[i_date].strip() if i_date < len(row) else ""
+        if not raw:
+            continue
+        day = _parse_day(raw)
+        if day is None:
+            if tail_only:
+                return None
+            # 想定外の日付表記は pandas の柔軟なパーサに任せる
+            return _normalize_with_pandas(csv_bytes)
+        if tail_only:
+            # ヘッダと列数が合わない（途中で列構成が変わった等）/ 日付が逆行する場合は諦める
+            if len(row) != len(header) or (prev_day is not None and day < prev_day):
+                return None
+            prev_day = day
+        # 同じ日付は後ろの行を優先（行番号で順序を保つ）
+        item = (day, n, row)
+        if len(heap) < 7:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    if tail_only and len(heap) < 7:
+        return None
 
     out: List[Dict[str, Any]] = []
-    for _, row in df.iterrows():
-        d = row["_date"]
-        if pd.isna(d):
-            continue
-        rec = {
-            "date": d.isoformat(),
-            "steps": _to_float(row[steps.name]) if steps is not None else None,
-            "sleep_hours": _to_float(row[sleep.name]) if sleep is not None else None,
-            "active_energy_kcal": _to_float(row[active.name]) if active is not None else None,
-            "resting_hr_bpm": _to_float(row[rhr.name]) if rhr is not None else None,
-            "weight_kg": _to_float(row[weight.name]) if weight is not None else None,
-        }
+    for day, _, row in sorted(heap):
+        rec: Dict[str, Any] = {"date": day.isoformat()}
+        for k, i in metric_idx:
+            rec[k] = _to_float(row[i]) if 0 <= i < len(row) else None
         out.append(rec)
+    return out
+
+def _read_csv_columns(csv_bytes: Union[bytes, bytearray], usecols: List[str], date_col: str) -> "pd.DataFrame":
+    # PyArrow の CSV リーダ（マルチスレッド）で必要な列だけ読む。
+    # 無い場合や、列数の足りない行などで PyArrow が読めない場合は pandas の C パーサ（欠けた列は NaN）
+    import pandas as pd
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pacsv
+    except ImportError:
+        pa = None
+
+    if pa is not None:
+        try:
+            table = pacsv.read_csv(
+                pa.BufferReader(csv_bytes),
+                read_options=pacsv.ReadOptions(use_threads=True, block_size=1 << 20),
+                # 日付列は文字列のまま受け取り、タイムゾーン付きの解釈は pd.to_datetime に任せる
+                convert_options=pacsv.ConvertOptions(include_columns=usecols, column_types={date_col: pa.string()}),
+            )
+            return table.to_pandas()
+        except pa.ArrowInvalid:
+            pass
+
+    return pd.read_csv(
+        io.BytesIO(csv_bytes), usecols=usecols, dtype={date_col: str}, engine="c", encoding="utf-8-sig"
+    )
+
+def _normalize_with_pandas(csv_bytes: Union[bytes, bytearray]) -> List[Dict[str, Any]]:
+    # 想定外の日付表記のときだけ通る経路なので、pandas はここで初めて読み込む
+    import pandas as pd
 
-    out.sort(key=lambda r: r["date"])
-    return out[-7:]
+    # ヘッダ行だけ先に見て必要な列を決め、本体はその列だけ読む
+    header = next(csv.reader(io.TextIOWrapper(io.BytesIO(csv_bytes), encoding="utf-8-sig", newline="")), [])
+    cmap = _colmap(header)
+
+    # 日付
+    if not cmap["date"]:
+        raise ValueError("CSVに日付列が見つかりません。")
+
+    usecols = list(dict.fromkeys(v for v in cmap.values() if v))
+    df = _read_csv_columns(csv_bytes, usecols, cmap["date"])
+
+    # 日付列だけで有効行・並び順・直近7件を決め、数値列はその7行分だけ変換して組み立てる
+    # （全行の DataFrame を dropna / sort / tail のたびにコピーしない）
+    dates = pd.to_datetime(df[cmap["date"]], errors="coerce").dt.date.dropna()
+    # 既に日付昇順なら（追記型CSVではほぼ常に）並べ替えは省く
+    if not dates.is_monotonic_increasing:
+        dates = dates.sort_values(kind="stable")
+    dates = dates.tail(7)
+    picked = df.loc[dates.index]
+    sub = pd.DataFrame({"date": dates})
+    for k in _METRIC_KEYS:
+        sub[k] = pd.to_numeric(picked[cmap[k]], errors="coerce").astype(float) if cmap[k] else float("nan")
+    dates = [d.isoformat() for d in sub["date"].tolist()]
+    sub = sub.astype(object).where(sub.notna(), None)
+    sub["date"] = dates
+    return sub.to_dict(orient="records")
+
+# =========================
+# 最新CSVのキャッシュ
+# - (id, modifiedTime) が変わらない限り再ダウンロード・再パースしない
+# - 一覧APIの結果も DRIVE_LIST_TTL 秒だけ使い回す
+# - TTL 切れ後は一覧APIで同期的に再検証し、変わっていればダウンロードしてから返す
+#   （httplib2 はスレッド非安全なので、Drive へのアクセスはワーカー1本に集約し、リクエスト側は結果を待つ）
+# =========================
+_CSV_CACHE: Dict[Tuple[str, str], Tuple[List[Dict[str, Any]], bytes, bytes]] = {}
+_LATEST: Dict[str, Dict[str, Any]] = {}  # folder_id -> {"rows", "rows_json", "rows_json_gz", "meta", "checked_at"}
+
+_DRIVE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="drive")
+_refresh_lock = threading.Lock()
+_refreshing: Dict[str, Future] = {}
+
+def _refresh_latest(folder_id: str) -> Dict[str, Any]:
+    latest = _find_latest_csv(folder_id)
+    meta = {
+        "id": latest["id"],
+        "name": latest.get("name"),
+        "modifiedTime": latest.get("modifiedTime"),  # ISO UTC
+    }
+    key = (meta["id"], meta["modifiedTime"])
+    hit = _CSV_CACHE.get(key)
+    if hit is None:
+        size = int(latest.get("size") or 0)
+        rows = None
+        # 大きいファイルは末尾だけ取得して解析し、足りなければ全体をダウンロード
+        if size > 2 * _TAIL_BYTES:
+            tail = _download_csv_head_and_tail(meta["id"])
+            if tail is not None:
+                rows = _last_7_rows(tail, tail_only=True)
+        if rows is None:
+            rows = normalize_and_last_7(_download_csv_bytes(meta["id"], size))
+        # /latest-health の本文（と gzip 版）はCSVが変わったときに1回だけ作る
+        rows_json = orjson.dumps(rows, option=_ORJSON_OPTS)
+        rows_json_gz = gzip.compress(rows_json, compresslevel=1)
+        _CSV_CACHE.clear()  # 最新の1件だけ保持
+        _DASHBOARD_CACHE.clear()
+        _CSV_CACHE[key] = hit = (rows, rows_json, rows_json_gz)
+    entry = {
+        "rows": hit[0],
+        "rows_json": hit[1],
+        "rows_json_gz": hit[2],
+        "meta": meta,
+        "checked_at": time.monotonic(),
+    }
+    _LATEST[folder_id] = entry
+    return entry
+
+def _log_refresh_error(fut: Future) -> None:
+    exc = fut.exception()
+    if exc is not None:
+        app.logger.error("最新CSVの更新に失敗しました", exc_info=exc)
+
+def _submit_refresh(folder_id: str) -> Future:
+    # 更新は同時に1本だけ（実行中なら同じ Future を共有）
+    with _refresh_lock:
+        fut = _refreshing.get(folder_id)
+        if fut is None or fut.done():
+            fut = _refreshing[folder_id] = _DRIVE_EXECUTOR.submit(_refresh_latest, folder_id)
+            fut.add_done_callback(_log_refresh_error)
+        return fut
+
+def _latest_entry(folder_id: str) -> Dict[str, Any]:
+    cur = _LATEST.get(folder_id)
+    if cur is not None and time.monotonic() - cur["checked_at"] < DRIVE_LIST_TTL:
+        return cur
+    # 初回・TTL 切れは更新を待つ（CSVが変わっていなければ一覧APIの1回だけで済む）
+    return _submit_refresh(folder_id).result()
+
+def load_latest_rows(folder_id: str) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    entry = _latest_entry(folder_id)
+    return entry["rows"], entry["meta"]
+
+def _cache_headers(meta: Dict[str, Any], variant: str = "") -> Dict[str, str]:
+    """modifiedTime 由来の ETag / Last-Modified（variant は同じCSVでも本文が変わる条件）"""
+    # 認証付きなので共有キャッシュには載せず、クライアントには毎回再検証させる
+    headers = {"Cache-Control": "private, no-cache"}
+    mtime = meta.get("modifiedTime")
+    if not mtime:
+        return headers
+    tag = mtime
+    if variant:
+        tag += "-" + hashlib.sha1(variant.encode()).hexdigest()[:8]
+    headers["ETag"] = quote_etag(tag, weak=True)
+    parsed = _parse_iso_dt(mtime)
+    if parsed != dt.datetime.min:
+        headers["Last-Modified"] = http_date(parsed)
+    return headers
+
+def _not_modified(headers: Dict[str, str]) -> bool:
+    etag = headers.get("ETag")
+    if not etag:
+        return False
+    tag, _ = unquote_etag(etag)
+    return request.if_none_match.contains_weak(tag)
 
 # =========================
 # YAMLダッシュボード生成
@@ -198,21 +540,36 @@ def _round0(x):
 def _round1(x):
     return None if x is None else round(float(x), 1)
 
-def build_yaml_dashboard(rows: List[Dict[str, Any]]) -> str:
-    import statistics as st
-    rows = sorted(rows, key=lambda r: r["date"])
+def _fmt_day(date, steps, sleep, active, weight) -> str:
+    return f"    - {{日付: {date}, 歩数: {steps}, 睡眠_h: {sleep}, 活動_kcal: {active}, 体重_kg: {weight}}}"
+
+def build_yaml_dashboard(
+    rows: List[Dict[str, Any]], *, header_date: Optional[str] = None, prefix: Optional[str] = None
+) -> str:
+    """header_date で見出し日付を差し替え、prefix は先頭行として出力する"""
+    # rows は normalize_and_last_7 で日付昇順に並んでいる前提
     latest = rows[-1]
 
-    def safe_vals(key):
-        return [r[key] for r in rows if r.get(key) is not None]
+    # 1パスで指標ごとの合計と件数を集計
+    sums = {k: [0.0, 0] for k in _METRIC_KEYS}
+    for r in rows:
+        for k in _METRIC_KEYS:
+            v = r.get(k)
+            if v is not None:
+                sums[k][0] += v
+                sums[k][1] += 1
+
+    def avg(key):
+        s, n = sums[key]
+        return s / n if n else None
 
-    avg_steps  = _round0(st.mean(safe_vals("steps"))) if safe_vals("steps") else None
-    avg_sleep  = _round1(st.mean(safe_vals("sleep_hours"))) if safe_vals("sleep_hours") else None
-    avg_active = _round0(st.mean(safe_vals("active_energy_kcal"))) if safe_vals("active_energy_kcal") else None
-    avg_weight = _round1(st.mean(safe_vals("weight_kg"))) if safe_vals("weight_kg") else None
+    avg_steps  = _round0(avg("steps"))
+    avg_sleep  = _round1(avg("sleep_hours"))
+    avg_active = _round0(avg("active_energy_kcal"))
+    avg_weight = _round1(avg("weight_kg"))
 
     flags = []
-    if latest.get("steps", 0) < 5000:
+    if (latest.get("steps") or 0) < 5000:  # 欠損(None)は記録なしと同じ扱い
         flags.append("今日の歩数が少なめ→途中経過の可能性または活動不足")
     short_sleep_days = [d for d in rows if (d.get("sleep_hours") is not None and d["sleep_hours"] < 6.0)]
     if short_sleep_days:
@@ -220,48 +577,79 @@ def build_yaml_dashboard(rows: List[Dict[str, Any]]) -> str:
     if latest.get("resting_hr_bpm") and latest["resting_hr_bpm"] >= 75:
         flags.append("安静時心拍がやや高め→睡眠/ストレス/水分を確認")
 
-    def fmt_day(d):
-        return (
-            f"    - {{日付: {d['date']}, 歩数: {_round0(d.get('steps'))}, "
-            f"睡眠_h: {_round1(d.get('sleep_hours'))}, 活動_kcal: {_round0(d.get('active_energy_kcal'))}, "
-            f"体重_kg: {_round1(d.get('weight_kg'))}}}"
-        )
-
-    y = []
-    y.append(f"日付: {latest['date']}")
-    y.append("最新値:")
-    y.append(f"  体重_kg: {_round1(latest.get('weight_kg'))}")
-    y.append(f"  睡眠_h: {_round1(latest.get('sleep_hours'))}")
-    y.append(f"  歩数: {_round0(latest.get('steps'))}")
-    y.append(f"  活動エネルギー_kcal: {_round0(latest.get('active_energy_kcal'))}")
-    y.append(f"  安静時心拍_bpm: {_round1(latest.get('resting_hr_bpm'))}")
-    y.append("週平均:")
-    y.append(f"  歩数: {avg_steps}")
-    y.append(f"  睡眠_h: {avg_sleep}")
-    y.append(f"  活動_kcal: {avg_active}")
-    y.append(f"  体重_kg: {avg_weight}")
-    y.append("週次サマリ:")
-    y.append(f"  期間: {rows[0]['date']}〜{rows[-1]['date']}")
-    y.append("  日別一覧:")
-    y.extend(fmt_day(d) for d in rows)
+    # 丸め済みの値を1行につき1回だけ計算し、「最新値」と「日別一覧」で共有
+    days = [
+        (d["date"], _round0(d.get("steps")), _round1(d.get("sleep_hours")),
+         _round0(d.get("active_energy_kcal")), _round1(d.get("weight_kg")))
+        for d in rows
+    ]
+    _, l_steps, l_sleep, l_active, l_weight = days[-1]
+
+    y = [] if prefix is None else [prefix]
+    y += [
+        f"日付: {header_date or latest['date']}",
+        "最新値:",
+        f"  体重_kg: {l_weight}",
+        f"  睡眠_h: {l_sleep}",
+        f"  歩数: {l_steps}",
+        f"  活動エネルギー_kcal: {l_active}",
+        f"  安静時心拍_bpm: {_round1(latest.get('resting_hr_bpm'))}",
+        "週平均:",
+        f"  歩数: {avg_steps}",
+        f"  睡眠_h: {avg_sleep}",
+        f"  活動_kcal: {avg_active}",
+        f"  体重_kg: {avg_weight}",
+        "週次サマリ:",
+        f"  期間: {rows[0]['date']}〜{rows[-1]['date']}",
+        "  日別一覧:",
+    ]
+    y += [_fmt_day(*d) for d in days]
     if flags:
         y.append("注意点:")
-        y.extend([f"  - {f}" for f in flags])
+        y += [f"  - {f}" for f in flags]
     return "\n".join(y)
 
 # =========================
 # 時刻系ユーティリティ
 # =========================
+@functools.lru_cache(maxsize=32)
+def _tz(name: str) -> dt.tzinfo:
+    """タイムゾーン名を解決（不正な名前は Asia/Tokyo にフォールバック）"""
+    try:
+        return ZoneInfo(name)
+    except Exception:
+        return ZoneInfo("Asia/Tokyo")
+
 def to_local_from_iso_utc(dt_str: str, tz_name: str) -> str:
     """ISO UTC文字列（例: 2025-08-25T00:42:10.123Z）をローカル時刻に整形"""
     if not dt_str:
         return ""
-    try:
-        tz = pytz.timezone(tz_name)
-    except Exception:
-        tz = pytz.timezone("Asia/Tokyo")
     dt_utc = dt.datetime.fromisoformat(dt_str.replace("Z", "+00:00")).astimezone(dt.timezone.utc)
-    return dt_utc.astimezone(tz).strftime("%Y-%m-%d %H:%M:%S")
+    return dt_utc.astimezone(_tz(tz_name)).strftime("%Y-%m-%d %H:%M:%S")
+
+# =========================
+# ダッシュボード本文（/daily-dashboard と .json で共有）
+# - (CSVキー, tz, 途中経過の日付) ごとに生成結果を使い回す
+# =========================
+_DASHBOARD_CACHE: Dict[Tuple[Tuple[str, str], str, Optional[str]], str] = {}
+_DASHBOARD_CACHE_MAX = 16
+
+def _render_dashboard(tz_name: str, force_today: bool) -> Tuple[str, Dict[str, Any], str]:
+    rows, meta = load_latest_rows(FOLDER_ID)
+    # 途中経過表示は日付が変わると見出しも変わるので、キーに当日日付を含める
+    today_local = dt.datetime.now(_tz(tz_name)).date().isoformat() if force_today else None
+    key = ((meta["id"], meta["modifiedTime"]), tz_name, today_local)
+    text = _DASHBOARD_CACHE.get(key)
+    if text is None:
+        # 見出し日付の上書き（途中経過） & 最終更新メタの追記
+        modified_local = to_local_from_iso_utc(meta.get("modifiedTime", ""), tz_name)
+        header_line = f"最終更新: {modified_local} [{meta.get('name')}]"
+        header_date = f"{today_local}（途中経過）" if today_local else None
+        text = build_yaml_dashboard(rows, header_date=header_date, prefix=header_line)
+        if len(_DASHBOARD_CACHE) >= _DASHBOARD_CACHE_MAX:
+            _DASHBOARD_CACHE.clear()
+        _DASHBOARD_CACHE[key] = text
+    return text, meta, f"{tz_name}|{today_local or ''}"
 
 # =========================
 # ルーティング
@@ -273,75 +661,77 @@ def healthz():
 @app.get("/latest-health")
 def latest_health():
     if not _auth_ok(request):
-        return jsonify({"error": "Unauthorized"}), 401
+        return _ojson({"error": "Unauthorized"}), 401
     try:
-        csv_bytes, _ = download_latest_csv_from_drive_with_meta(FOLDER_ID)
-        data = normalize_and_last_7(csv_bytes)
-        return jsonify(data), 200
+        entry = _latest_entry(FOLDER_ID)
+        headers = _cache_headers(entry["meta"])
+        if _not_modified(headers):
+            return "", 304, headers
+        if request.accept_encodings["gzip"]:
+            # 事前に圧縮済みの本文を返す（flask-compress は Content-Encoding 付きなら触らない）
+            resp = Response(entry["rows_json_gz"], mimetype="application/json")
+            resp.headers["Content-Encoding"] = "gzip"
+            resp.headers["Vary"] = "Accept-Encoding"
+            return resp, 200, headers
+        return Response(entry["rows_json"], mimetype="application/json"), 200, headers
     except FileNotFoundError as e:
-        return jsonify({"error": str(e)}), 500
+        return _ojson({"error": str(e)}), 500
     except Exception as e:
-        return jsonify({"error": f"CSV取得/読込に失敗: {str(e)}"}), 500
+        return _ojson({"error": f"CSV取得/読込に失敗: {str(e)}"}), 500
 
 @app.get("/daily-dashboard")
 def daily_dashboard():
     if not _auth_ok(request):
-        return jsonify({"error": "Unauthorized"}), 401
+        return _ojson({"error": "Unauthorized"}), 401
     tz_name = request.args.get("tz", "Asia/Tokyo")
     force_today = request.args.get("force_today", "0").lower() in ("1", "true", "yes")
 
     try:
-        csv_bytes, meta = download_latest_csv_from_drive_with_meta(FOLDER_ID)
-        rows = normalize_and_last_7(csv_bytes)
-        text = build_yaml_dashboard(rows)
-
-        # 見出し日付の上書き（途中経過） & 最終更新メタの追記
-        modified_local = to_local_from_iso_utc(meta.get("modifiedTime", ""), tz_name)
-        header_line = f"最終更新: {modified_local} [{meta.get('name')}]"
-        if force_today:
-            try:
-                today_local = dt.datetime.now(pytz.timezone(tz_name)).date().isoformat()
-            except Exception:
-                today_local = dt.date.today().isoformat()
-            text = text.replace(f"日付: {rows[-1]['date']}", f"日付: {today_local}（途中経過）")
-        text = header_line + "\n" + text
-
+        text, meta, variant = _render_dashboard(tz_name, force_today)
+        headers = _cache_headers(meta, variant)
+        if _not_modified(headers):
+            return "", 304, headers
         resp = Response(text, content_type="text/plain; charset=utf-8")
-        resp.headers["Cache-Control"] = "no-store"
+        resp.headers.update(headers)
         return resp, 200
     except FileNotFoundError as e:
-        return jsonify({"error": str(e)}), 500
+        return _ojson({"error": str(e)}), 500
     except Exception as e:
-        return jsonify({"error": f"生成失敗: {str(e)}"}), 500
+        return _ojson({"error": f"生成失敗: {str(e)}"}), 500
 
 @app.get("/daily-dashboard.json")
 def daily_dashboard_json():
     if not _auth_ok(request):
-        return jsonify({"error": "Unauthorized"}), 401
+        return _ojson({"error": "Unauthorized"}), 401
     tz_name = request.args.get("tz", "Asia/Tokyo")
     force_today = request.args.get("force_today", "0").lower() in ("1", "true", "yes")
 
     try:
-        csv_bytes, meta = download_latest_csv_from_drive_with_meta(FOLDER_ID)
-        rows = normalize_and_last_7(csv_bytes)
-        text = build_yaml_dashboard(rows)
-
-        # 同様に加工して JSON で返す
-        modified_local = to_local_from_iso_utc(meta.get("modifiedTime", ""), tz_name)
-        header_line = f"最終更新: {modified_local} [{meta.get('name')}]"
-        if force_today:
-            try:
-                today_local = dt.datetime.now(pytz.timezone(tz_name)).date().isoformat()
-            except Exception:
-                today_local = dt.date.today().isoformat()
-            text = text.replace(f"日付: {rows[-1]['date']}", f"日付: {today_local}（途中経過）")
-        text = header_line + "\n" + text
-
-        return jsonify({"content": text}), 200
+        text, meta, variant = _render_dashboard(tz_name, force_today)
+        headers = _cache_headers(meta, variant)
+        if _not_modified(headers):
+            return "", 304, headers
+        return _ojson({"content": text}), 200, headers
     except FileNotFoundError as e:
-        return jsonify({"error": str(e)}), 500
+        return _ojson({"error": str(e)}), 500
     except Exception as e:
-        return jsonify({"error": f"生成失敗: {str(e)}"}), 500
+        return _ojson({"error": f"生成失敗: {str(e)}"}), 500
+
+# =========================
+# /healthz は Flask を通さずに WSGI の手前で返す（死活監視の ping 用）
+# =========================
+_HEALTHZ_HEADERS = [("Content-Type", "text/plain; charset=utf-8"), ("Content-Length", "2")]
+_flask_wsgi_app = app.wsgi_app
+
+def _wsgi_app(environ, start_response):
+    if environ.get("PATH_INFO") == "/healthz":
+        method = environ.get("REQUEST_METHOD")
+        if method in ("GET", "HEAD"):
+            start_response("200 OK", _HEALTHZ_HEADERS)
+            return [b"ok"] if method == "GET" else []
+    return _flask_wsgi_app(environ, start_response)
+
+app.wsgi_app = _wsgi_app
 
 if __name__ == "__main__":
     # ローカル実行用